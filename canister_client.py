@@ -0,0 +1,387 @@
+#!/usr/bin/env python3
+"""
+In-process client for the ai_api_backend canister
+Uses one ic-py agent with Candid encoded in Python, instead of spawning
+a dfx process (and re-negotiating TLS) for every call
+"""
+
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, Union
+
+import httpx
+import numpy as np
+from ic.agent import Agent, sign_request
+from ic.candid import decode, encode, Types
+from ic.certificate import lookup
+from ic.client import Client
+from ic.identity import Identity
+from ic.principal import Principal
+from tqdm import tqdm
+
+IC_URL = "https://ic0.app"
+CANISTER_NAME = "ai_api_backend"
+CANISTER_IDS_FILE = "canister_ids.json"
+
+# Update calls are bound by network round-trips, so several can be in flight at once
+UPLOAD_CONCURRENCY = 12
+
+# Seconds between request status checks while an update call is processed, and
+# before giving up on one whose status never settles
+POLL_INTERVAL = 1.0
+UPDATE_TIMEOUT = 60.0
+
+# Only the submission of a call is ever resent, and always as the same signed envelope:
+# the IC executes a request id at most once, so a resend of a call that did arrive
+# can't store records twice. Once submitted, a call is only polled, never resent.
+RETRYABLE_ERRORS = (httpx.TransportError,)
+UPLOAD_RETRIES = 3
+RETRY_BACKOFF = 1.0  # Seconds before the first retry, doubled after each
+
+# Boundary node replies to a submitted call when it rate-limits or is overloaded;
+# the call was not accepted, so it is safe to resend after slowing down
+RATE_LIMIT_STATUSES = (429, 503)
+MAX_THROTTLE_INTERVAL = 8.0  # Seconds between update calls at the most throttled
+RATE_LIMIT_TIMEOUT = 60.0  # Seconds a call keeps being resent while rate limited
+THROTTLE_RECOVERY = 5  # Consecutive successes before halving the interval again
+
+# Ingress messages are capped at 2MiB; leave headroom for the request envelope
+MAX_BATCH_BYTES = 1_800_000
+
+# Mirrors `personality_embedding` in src/ai_api_backend/ai_api_backend.did
+PERSONALITY_EMBEDDING = Types.Record({
+    "text": Types.Text,
+    "embedding": Types.Vec(Types.Float32),
+    "channel_id": Types.Text,
+    "category": Types.Text,
+    "importance": Types.Float32,
+    "created_at": Types.Nat64,
+})
+
+# Mirrors `search_result`; decoding needs it to recover field names from their hashes
+SEARCH_RESULT = Types.Record({
+    "text": Types.Text,
+    "similarity": Types.Float32,
+    "category": Types.Text,
+    "importance": Types.Float32,
+    "source_info": Types.Text,
+    "content_type": Types.Text,
+})
+
+class CallRejected(Exception):
+    """The boundary node refused an update call, or the canister rejected it"""
+
+class RateLimited(Exception):
+    """The boundary node turned a call away with a rate-limit or overload status"""
+
+class Limiter:
+    """Adaptive spacing between update calls, shared by every call in flight.
+    
+    Starts with no delay, doubles the interval each time a call is rate limited and
+    halves it again (down to zero) after THROTTLE_RECOVERY calls in a row succeed.
+    """
+
+    def __init__(self):
+        self.interval = 0.0
+        self.next_slot = 0.0
+        self.successes = 0
+
+    def reserve(self) -> float:
+        """Claim the next send slot; returns the seconds to wait before sending"""
+        now = time.monotonic()
+        slot = max(now, self.next_slot)
+        self.next_slot = slot + self.interval
+        return slot - now
+
+    def succeeded(self):
+        self.successes += 1
+        if self.interval and self.successes >= THROTTLE_RECOVERY:
+            self.interval = self.interval / 2 if self.interval > 0.1 else 0.0
+            self.successes = 0
+
+    def throttled(self):
+        self.interval = min(MAX_THROTTLE_INTERVAL, max(self.interval * 2, 0.25))
+        self.successes = 0
+        # Hold back the next send too, not just the ones after it
+        self.next_slot = max(self.next_slot, time.monotonic() + self.interval)
+
+def check_call_response(ret: httpx.Response):
+    """Raise unless the boundary node accepted a submitted call"""
+    if ret.status_code in RATE_LIMIT_STATUSES:
+        raise RateLimited(f"HTTP {ret.status_code}: {ret.text}")
+    if not ret.is_success:
+        raise CallRejected(f"HTTP {ret.status_code}: {ret.text}")
+
+class SessionClient(Client):
+    """ic-py Client that keeps its HTTP connection pools open across requests.
+    
+    Searches use the blocking query; updates only go through the async methods.
+    """
+
+    def __init__(self, url: str = IC_URL, timeout: float = 30.0):
+        super().__init__(url)
+        self.session = httpx.Client(timeout=timeout, headers={'Content-Type': 'application/cbor'})
+        # Async pool for the event loop currently uploading; opened on first use and
+        # closed with aclose() before that loop ends
+        self.async_session = None
+
+    def query(self, canister_id, data, **kwargs):
+        ret = self.session.post(f"{self.url}/api/v2/canister/{canister_id}/query", content=data)
+        return ret.content
+
+    def _async_session(self) -> httpx.AsyncClient:
+        if self.async_session is None:
+            self.async_session = httpx.AsyncClient(timeout=self.session.timeout, headers=self.session.headers)
+        return self.async_session
+
+    async def query_async(self, canister_id, data, **kwargs):
+        ret = await self._async_session().post(f"{self.url}/api/v2/canister/{canister_id}/query", content=data)
+        return ret.content
+
+    async def call_async(self, canister_id, req_id, data, **kwargs):
+        ret = await self._async_session().post(f"{self.url}/api/v2/canister/{canister_id}/call", content=data)
+        check_call_response(ret)
+        return req_id
+
+    async def read_state_async(self, canister_id, data, **kwargs):
+        ret = await self._async_session().post(f"{self.url}/api/v2/canister/{canister_id}/read_state", content=data)
+        return ret.content
+
+    async def aclose(self):
+        """Close the async pool (its connections belong to the event loop that opened them)"""
+        if self.async_session is not None:
+            await self.async_session.aclose()
+            self.async_session = None
+
+def load_identity() -> Identity:
+    """Load the active dfx identity, resolved the way dfx does: DFX_IDENTITY, then the
+    one selected with `dfx identity use` (recorded in identity.json), then default"""
+    name = os.environ.get("DFX_IDENTITY")
+    if not name:
+        selected_path = os.path.expanduser("~/.config/dfx/identity.json")
+        if os.path.exists(selected_path):
+            with open(selected_path, 'r') as f:
+                name = json.load(f).get("default")
+    
+    pem_path = os.path.expanduser(f"~/.config/dfx/identity/{name or 'default'}/identity.pem")
+    with open(pem_path, 'r') as f:
+        return Identity.from_pem(f.read())
+
+def load_canister_id(canister_name: str = CANISTER_NAME, network: str = "ic") -> str:
+    """Resolve a canister id from canister_ids.json"""
+    with open(CANISTER_IDS_FILE, 'r') as f:
+        return json.load(f)[canister_name][network]
+
+def to_candid_vector(embedding) -> List[float]:
+    """Float values for a `vec float32` argument (packed as 4 little-endian bytes each)"""
+    # One C-level conversion; ic-py only accepts Python floats, not numpy scalars
+    return np.asarray(embedding, dtype=np.float32).tolist()
+
+def to_candid_record(embedding: Dict) -> Dict:
+    """Keep only the fields of `personality_embedding`, with the types Candid expects"""
+    return {
+        "text": embedding["text"],
+        "embedding": to_candid_vector(embedding["embedding"]),
+        "channel_id": embedding["channel_id"],
+        "category": embedding["category"],
+        "importance": float(embedding["importance"]),
+        "created_at": int(embedding["created_at"]),
+    }
+
+def encoded_size(embedding: Dict) -> int:
+    """Upper-bound estimate of a record's size in a Candid-encoded batch"""
+    text_bytes = len(embedding["text"].encode('utf-8'))
+    label_bytes = len(embedding["channel_id"]) + len(embedding["category"])
+    # 4 bytes per float32, plus importance, created_at and length prefixes
+    return 4 * len(embedding["embedding"]) + text_bytes + label_bytes + 32
+
+def split_batches(embeddings: List[Dict], max_bytes: int = MAX_BATCH_BYTES) -> List[List[Dict]]:
+    """Pack records into as few batches as fit in one ingress message each"""
+    batches = []
+    batch = []
+    batch_bytes = 0
+    
+    for embedding in embeddings:
+        size = encoded_size(embedding)
+        if batch and batch_bytes + size > max_bytes:
+            batches.append(batch)
+            batch = []
+            batch_bytes = 0
+        batch.append(embedding)
+        batch_bytes += size
+    
+    if batch:
+        batches.append(batch)
+    return batches
+
+class CanisterClient:
+    """Shared agent for calls to the ai_api_backend canister"""
+
+    def __init__(self, canister_name: str = CANISTER_NAME, url: str = IC_URL):
+        self.canister_id = load_canister_id(canister_name)
+        self.agent = Agent(load_identity(), SessionClient(url))
+        self.limiter = Limiter()
+
+    def store_personality_batch(self, embeddings: List[Dict]) -> str:
+        """Store a batch of embedding records in one update call"""
+        return self._update("store_personality_batch", self._encode_batch(embeddings))
+
+    def store_batches_concurrently(self, batches: List[List[Dict]],
+                                   concurrency: int = UPLOAD_CONCURRENCY) -> List[Union[str, Exception]]:
+        """Store batches (see split_batches) with up to `concurrency` update calls in flight.
+        
+        Each batch is Candid-encoded in a worker process once it gets an upload slot, so
+        encoding overlaps with the calls already in flight instead of stalling the event
+        loop, and at most `concurrency` encoded payloads are held at once.
+        
+        Returns one entry per batch, in order: the canister's reply, or the
+        exception that call raised.
+        """
+        with ProcessPoolExecutor(max_workers=min(len(batches), os.cpu_count() or 1) or 1) as pool:
+            async def encode_and_store(batch):
+                arg = await asyncio.get_running_loop().run_in_executor(pool, self._encode_batch, batch)
+                return await self._update_async("store_personality_batch", arg)
+
+            return self._run_concurrently(encode_and_store, batches, concurrency)
+
+    def search_unified_knowledge(self, embedding, categories: Optional[List[str]] = None,
+                                 limit: int = 5) -> List[Dict]:
+        """Query personality and wiki embeddings together, optionally filtered by category"""
+        arg = encode([
+            {'type': Types.Vec(Types.Float32), 'value': to_candid_vector(embedding)},
+            {'type': Types.Opt(Types.Vec(Types.Text)), 'value': [categories] if categories else []},
+            {'type': Types.Opt(Types.Nat32), 'value': [limit]},
+        ])
+        return self._query("search_unified_knowledge", arg, [Types.Vec(SEARCH_RESULT)])
+
+    def search_wiki_content(self, embedding, content_type: Optional[str] = None,
+                            limit: int = 3) -> List[Dict]:
+        """Query wiki embeddings only, optionally filtered by content type"""
+        arg = encode([
+            {'type': Types.Vec(Types.Float32), 'value': to_candid_vector(embedding)},
+            {'type': Types.Opt(Types.Text), 'value': [content_type] if content_type else []},
+            {'type': Types.Opt(Types.Nat32), 'value': [limit]},
+        ])
+        return self._query("search_wiki_content", arg, [Types.Vec(SEARCH_RESULT)])
+
+    def _query(self, method: str, arg: bytes, return_type: List):
+        """Query call, raising the canister's reject message as an error"""
+        result = self.agent.query_raw(self.canister_id, method, arg, return_type=return_type)
+        # ic-py returns a reject as its message string instead of raising
+        if isinstance(result, str):
+            raise CallRejected(f"{method} rejected: {result}")
+        return result[0]['value']
+
+    def _update(self, method: str, arg: bytes) -> str:
+        """Blocking update call (see _update_async)"""
+        return self._run(self._update_async(method, arg))
+
+    async def _update_async(self, method: str, arg: bytes) -> str:
+        """Update call: sign it once, submit it (see _submit_async), then await its reply.
+        
+        Same request as ic-py's update_raw_async, but polled with asyncio.sleep: ic-py
+        polls through the blocking waiter.wait, which stalls every other call in flight.
+        """
+        request = {
+            'request_type': "call",
+            'sender': self.agent.identity.sender().bytes,
+            'canister_id': Principal.from_str(self.canister_id).bytes,
+            'method_name': method,
+            'arg': arg,
+            'ingress_expiry': self.agent.get_expiry_date(),
+        }
+        req_id, envelope = sign_request(request, self.agent.identity)
+        await self._submit_async(method, req_id, envelope)
+        
+        deadline = time.monotonic() + UPDATE_TIMEOUT
+        while True:
+            try:
+                status, cert = await self.agent.request_status_raw_async(self.canister_id, req_id)
+            except RETRYABLE_ERRORS as e:
+                # The call is already submitted: check on the same request id, never resend it
+                tqdm.write(f"⚠️  Checking on {method} failed ({e}), checking again...")
+                status = None
+            if status in ('replied', 'rejected', 'done'):
+                break
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"{method} still {status or 'unknown to the IC'} after {UPDATE_TIMEOUT:.0f}s; "
+                                   f"it may yet be stored, so check before resending")
+            await asyncio.sleep(POLL_INTERVAL)
+        
+        if status == 'replied':
+            return decode(lookup([b'request_status', req_id, b'reply'], cert))[0]['value']
+        if status == 'rejected':
+            message = lookup([b'request_status', req_id, b'reject_message'], cert)
+            raise CallRejected(f"{method} rejected: {message.decode()}")
+        raise CallRejected(f"{method} finished but its reply has already been pruned")
+
+    async def _submit_async(self, method: str, req_id: bytes, envelope: bytes):
+        """Send a signed call, paced by the limiter, resending the same envelope after
+        transport failures (up to UPLOAD_RETRIES attempts) or rate limiting (for up to
+        RATE_LIMIT_TIMEOUT seconds)"""
+        transport_failures = 0
+        rate_limited_since = None
+        
+        while True:
+            await asyncio.sleep(self.limiter.reserve())
+            try:
+                await self.agent.client.call_async(self.canister_id, req_id, envelope)
+            except RateLimited as e:
+                rate_limited_since = rate_limited_since or time.monotonic()
+                self._on_rate_limited(method, e, rate_limited_since)
+                continue
+            except RETRYABLE_ERRORS as e:
+                await asyncio.sleep(self._retry_delay(method, e, transport_failures))
+                transport_failures += 1
+                continue
+            self.limiter.succeeded()
+            return
+
+    def _on_rate_limited(self, method: str, error: Exception, since: float):
+        self.limiter.throttled()
+        if time.monotonic() - since >= RATE_LIMIT_TIMEOUT:
+            raise error
+        tqdm.write(f"⚠️  {method} was rate limited ({error}), "
+                   f"slowing to one call every {self.limiter.interval:.2f}s...")
+
+    @staticmethod
+    def _retry_delay(method: str, error: Exception, attempt: int) -> float:
+        if attempt == UPLOAD_RETRIES - 1:
+            raise error
+        delay = RETRY_BACKOFF * 2 ** attempt
+        tqdm.write(f"⚠️  Submitting {method} failed ({error}), resending in {delay:.0f}s...")
+        return delay
+
+    @staticmethod
+    def _encode_batch(embeddings: List[Dict]) -> bytes:
+        records = [to_candid_record(embedding) for embedding in embeddings]
+        return encode([{'type': Types.Vec(PERSONALITY_EMBEDDING), 'value': records}])
+
+    def _run_concurrently(self, upload, items: List, concurrency: int) -> List[Union[str, Exception]]:
+        async def upload_all():
+            semaphore = asyncio.Semaphore(concurrency)
+
+            with tqdm(total=len(items), desc="📤 Uploading", unit="call") as progress:
+                async def upload_one(item):
+                    async with semaphore:
+                        try:
+                            return await upload(item)
+                        finally:
+                            progress.update(1)
+
+                return await asyncio.gather(*[upload_one(item) for item in items], return_exceptions=True)
+
+        return self._run(upload_all())
+
+    def _run(self, coroutine):
+        """Run a coroutine on a fresh event loop, closing the async pool before the loop ends"""
+        async def run_and_close():
+            try:
+                return await coroutine
+            finally:
+                await self.agent.client.aclose()
+
+        return asyncio.run(run_and_close())
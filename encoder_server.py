@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Local embedding service for Lain's knowledge scripts
+Loads the encoder once and keeps it warm; start it in the background, then run the
+other scripts with LAIN_ENCODER_URL=http://127.0.0.1:8765 so they skip model loading
+"""
+
+import json
+import os
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+HOST = "127.0.0.1"
+PORT = 8765
+
+if os.environ.pop("LAIN_ENCODER_URL", None):
+    print("⚠️  Ignoring LAIN_ENCODER_URL: the server encodes with its own model")
+
+import encoder
+
+class EncodeHandler(BaseHTTPRequestHandler):
+    """POST /encode with {"texts": [...]} returns one little-endian float32 row per text"""
+
+    def do_POST(self):
+        if self.path != "/encode":
+            self.send_error(404)
+            return
+        
+        try:
+            texts = json.loads(self.rfile.read(int(self.headers["Content-Length"])))["texts"]
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, f"Expected a JSON body with a texts list: {e}")
+            return
+        
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            self.send_error(400, "texts must be a list of strings")
+            return
+        
+        try:
+            body = encoder.encode_texts(texts).astype('<f4').tobytes()
+        except Exception as e:
+            self.send_error(500, f"Encoding failed: {e!r}")
+            return
+        
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("X-Cache-Namespace", encoder.CACHE_NAMESPACE)
+        self.end_headers()
+        self.wfile.write(body)
+
+def main():
+    # Load the model up front so the first request doesn't pay for it
+    encoder.get_model()
+    
+    # One request at a time: the model session is shared and batches already use every core
+    server = HTTPServer((HOST, PORT), EncodeHandler)
+    print(f"🧠 Serving {encoder.CACHE_NAMESPACE} embeddings on http://{HOST}:{PORT}/encode")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n👋 Encoder server stopped")
+
+if __name__ == "__main__":
+    main()
@@ -5,18 +5,24 @@ Generates embeddings for Lain's personality traits and memex-wiki documentation
 Uploads embeddings to IC canister for unified knowledge retrieval
 """
 
-from sentence_transformers import SentenceTransformer
+import itertools
 import json
-import subprocess
 import time
 import os
 import re
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from typing import List, Dict, Tuple, Optional
+from typing import Iterator, List, Dict, Tuple, Optional
 
-# Load a good embedding model (you can use different ones)
-model = SentenceTransformer('all-MiniLM-L6-v2')  # 384 dimensions
-# Alternative: 'all-mpnet-base-v2' for 768 dimensions (better quality)
+import numpy as np
+from tqdm import tqdm
+
+from canister_client import CanisterClient, split_batches
+from encoder import encode_texts
+
+# Local backup of generated embeddings: "vecs" is a float32 matrix whose row i belongs
+# to record i of "meta", the remaining fields as a JSON string
+EMBEDDINGS_FILE = "lain_personality_embeddings.npz"
 
 # Lain's personality data for each channel
 LAIN_PERSONALITY = {
@@ -202,6 +208,25 @@ WIKI_CATEGORIZATION = {
     }
 }
 
+# Markdown patterns, compiled once instead of on every call
+_WIKI_CATEGORY_RES = {
+    category: [re.compile(pattern) for pattern in config["patterns"]]
+    for category, config in WIKI_CATEGORIZATION.items()
+}
+_METADATA_PATTERNS = {
+    'status': re.compile(r'\*\*Status\*\*:\s*(.+)'),
+    'type': re.compile(r'\*\*Type\*\*:\s*(.+)'),
+    'url': re.compile(r'\*\*URL\*\*:\s*(.+)'),
+    'platform': re.compile(r'\*\*Platform\*\*:\s*(.+)')
+}
+_TITLE_RE = re.compile(r'^#\s+(.+)$', re.MULTILINE)
+_SECTION_SPLIT_RE = re.compile(r'\n##\s+(.+)\n')
+# Code blocks, inline code and links in one alternation: code is dropped,
+# links keep their text (group 1 is empty for the code alternatives)
+_MARKUP_RE = re.compile(r'```[\s\S]*?```|`[^`]+`|\[([^\]]+)\]\([^)]+\)')
+_MD_CHARS_TRANS = str.maketrans('', '', '#*_`')
+_SENTENCE_RE = re.compile(r'[^.!?]+')
+
 def parse_markdown_file(file_path: str) -> Dict[str, str]:
     """Parse markdown file and extract metadata and content sections"""
     try:
@@ -213,41 +238,37 @@ def parse_markdown_file(file_path: str) -> Dict[str, str]:
         content_sections = {}
         
         # Look for structured metadata (Status, Type, URL, etc.)
-        metadata_patterns = {
-            'status': r'\*\*Status\*\*:\s*(.+)',
-            'type': r'\*\*Type\*\*:\s*(.+)',
-            'url': r'\*\*URL\*\*:\s*(.+)',
-            'platform': r'\*\*Platform\*\*:\s*(.+)'
-        }
-        
-        for key, pattern in metadata_patterns.items():
-            match = re.search(pattern, content)
+        for key, pattern in _METADATA_PATTERNS.items():
+            match = pattern.search(content)
             if match:
                 metadata[key] = match.group(1).strip()
         
         # Extract title (first # heading)
-        title_match = re.search(r'^#\s+(.+)$', content, re.MULTILINE)
+        title_match = _TITLE_RE.search(content)
         if title_match:
             metadata['title'] = title_match.group(1).strip()
         
         # Split content by major sections (## headings)
-        sections = re.split(r'\n##\s+(.+)\n', content)
+        sections = _SECTION_SPLIT_RE.split(content)
         
         # First section is before any ## heading (overview/intro)
         if sections[0].strip():
             content_sections['overview'] = sections[0].strip()
         
-        # Process subsequent sections
-        for i in range(1, len(sections), 2):
-            if i + 1 < len(sections):
-                section_title = sections[i].strip().lower().replace(' ', '_')
-                section_content = sections[i + 1].strip()
-                content_sections[section_title] = section_content
+        # Process subsequent sections as (title, body) pairs
+        pairs = iter(sections[1:])
+        for section_title, section_content in zip(pairs, pairs):
+            section_title = section_title.strip().lower().replace(' ', '_')
+            content_sections[section_title] = section_content.strip()
+        
+        # Clean every section once here, so the summary and the section
+        # records below don't re-run the markdown cleaner on the same text
+        cleaned_sections = {name: clean_markdown(body) for name, body in content_sections.items()}
         
         return {
             'metadata': metadata,
             'sections': content_sections,
-            'full_content': content
+            'cleaned_sections': cleaned_sections
         }
     
     except Exception as e:
@@ -258,50 +279,55 @@ def categorize_wiki_content(file_path: str) -> str:
     """Categorize wiki content based on file path patterns"""
     relative_path = os.path.relpath(file_path, start="/Users/laincorp/LainCorp/memex-wiki/docs")
     
-    for category, config in WIKI_CATEGORIZATION.items():
-        for pattern in config["patterns"]:
-            if re.search(pattern, relative_path):
+    for category, patterns in _WIKI_CATEGORY_RES.items():
+        for pattern in patterns:
+            if pattern.search(relative_path):
                 return category
     
     return "general-docs"
 
-def extract_meaningful_content(content: str, max_chars: int = 1000) -> List[str]:
-    """Extract meaningful chunks from content for embedding"""
-    # Remove markdown formatting for cleaner embeddings
-    cleaned = re.sub(r'```[\s\S]*?```', '', content)  # Remove code blocks
-    cleaned = re.sub(r'`[^`]+`', '', cleaned)  # Remove inline code
-    cleaned = re.sub(r'\[([^\]]+)\]\([^)]+\)', r'\1', cleaned)  # Convert links to text
-    cleaned = re.sub(r'[#*_`]', '', cleaned)  # Remove markdown formatting
-    cleaned = re.sub(r'\n+', ' ', cleaned)  # Replace newlines with spaces
-    cleaned = ' '.join(cleaned.split())  # Normalize whitespace
-    
-    # Split into meaningful chunks
+def clean_markdown(content: str) -> str:
+    """Remove markdown formatting for cleaner embeddings"""
+    cleaned = _MARKUP_RE.sub(r'\1', content)  # Remove code, convert links to text
+    cleaned = cleaned.translate(_MD_CHARS_TRANS)  # Remove markdown formatting
+    return ' '.join(cleaned.split())  # Collapse newlines and whitespace
+
+def chunk_cleaned_text(cleaned: str, max_chars: int = 1000) -> List[str]:
+    """Split cleaned text into meaningful chunks for embedding"""
     chunks = []
     
     if len(cleaned) <= max_chars:
         chunks.append(cleaned)
     else:
-        # Split by sentences, trying to keep chunks under max_chars
-        sentences = re.split(r'[.!?]+', cleaned)
-        current_chunk = ""
+        # Walk sentences, trying to keep chunks under max_chars; sentences are
+        # buffered and joined once per chunk instead of concatenated one by one
+        buffer = []
+        size = 0
         
-        for sentence in sentences:
-            sentence = sentence.strip()
+        for match in _SENTENCE_RE.finditer(cleaned):
+            sentence = match.group().strip()
             if not sentence:
                 continue
-                
-            if len(current_chunk) + len(sentence) <= max_chars:
-                current_chunk += sentence + ". "
-            else:
-                if current_chunk:
-                    chunks.append(current_chunk.strip())
-                current_chunk = sentence + ". "
+            
+            if buffer and size + len(sentence) > max_chars:
+                chunks.append('. '.join(buffer) + '.')
+                buffer.clear()
+                size = 0
+            
+            buffer.append(sentence)
+            size += len(sentence) + 2
         
-        if current_chunk:
-            chunks.append(current_chunk.strip())
+        if buffer:
+            chunks.append('. '.join(buffer) + '.')
     
     return [chunk for chunk in chunks if len(chunk.strip()) > 50]  # Filter out very short chunks
 
+def maybe_chunks(cleaned: str, max_chars: int) -> List[str]:
+    """Chunk a cleaned section, skipping sections too short to be meaningful"""
+    if len(cleaned) < 100:
+        return []
+    return chunk_cleaned_text(cleaned, max_chars)
+
 def process_wiki_file(file_path: str) -> List[Dict]:
     """Process a single wiki markdown file into embedding records"""
     parsed = parse_markdown_file(file_path)
@@ -316,17 +342,18 @@ def process_wiki_file(file_path: str) -> List[Dict]:
     title = parsed['metadata'].get('title', file_name.replace('.md', ''))
     overview_text = ""
     
-    if 'overview' in parsed['sections']:
-        overview_text = parsed['sections']['overview']
-    elif parsed['sections']:
+    cleaned_sections = parsed['cleaned_sections']
+    if 'overview' in cleaned_sections:
+        overview_text = cleaned_sections['overview']
+    elif cleaned_sections:
         # Use first section if no overview
-        first_section = list(parsed['sections'].values())[0]
+        first_section = next(iter(cleaned_sections.values()), '')
         overview_text = first_section[:500] + "..." if len(first_section) > 500 else first_section
     
     if overview_text:
         # Create a comprehensive summary embedding
-        summary_text = f"{title}: {overview_text}"
-        content_chunks = extract_meaningful_content(summary_text, max_chars=800)
+        summary_text = f"{clean_markdown(title)}: {overview_text}"
+        content_chunks = chunk_cleaned_text(summary_text, max_chars=800)
         
         for chunk in content_chunks:
             embedding_record = {
@@ -343,16 +370,11 @@ def process_wiki_file(file_path: str) -> List[Dict]:
     important_sections = ['features', 'architecture', 'core_mission', 'key_concepts', 
                          'overview', 'getting_started', 'installation', 'usage']
     
-    for section_name, section_content in parsed['sections'].items():
-        if not section_content or len(section_content) < 100:
-            continue
-        
+    for section_name, cleaned_section in cleaned_sections.items():
         # Determine importance based on section type
         importance = 0.8 if section_name.lower() in important_sections else 0.6
         
-        content_chunks = extract_meaningful_content(section_content, max_chars=900)
-        
-        for chunk in content_chunks:
+        for chunk in maybe_chunks(cleaned_section, max_chars=900):
             embedding_record = {
                 "text": f"{title} - {section_name.replace('_', ' ').title()}: {chunk}",
                 "category": f"wiki_{category}",
@@ -365,6 +387,24 @@ def process_wiki_file(file_path: str) -> List[Dict]:
     
     return embeddings
 
+def process_wiki_file_logged(file_path: str) -> List[Dict]:
+    """Process a wiki file in a worker process, reporting errors instead of raising"""
+    try:
+        return process_wiki_file(file_path)
+    except Exception as e:
+        print(f"  ❌ Error processing {file_path}: {e}")
+        return []
+
+def iter_markdown_files(root: str) -> Iterator[str]:
+    """Recursively yield non-hidden .md files under root"""
+    # DirEntry caches its type from the directory listing, avoiding a stat per file
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_markdown_files(entry.path)
+            elif entry.name.endswith('.md') and not entry.name.startswith('.'):
+                yield entry.path
+
 def process_memex_wiki(wiki_path: str = "/Users/laincorp/LainCorp/memex-wiki/docs") -> List[Dict]:
     """Process all markdown files in memex-wiki and generate embeddings"""
     print(f"🔍 Processing memex-wiki content from {wiki_path}...")
@@ -373,197 +413,120 @@ def process_memex_wiki(wiki_path: str = "/Users/laincorp/LainCorp/memex-wiki/doc
         print(f"❌ Wiki path not found: {wiki_path}")
         return []
     
-    all_embeddings = []
-    markdown_files = []
-    
-    # Find all markdown files recursively
-    for root, dirs, files in os.walk(wiki_path):
-        for file in files:
-            if file.endswith('.md') and not file.startswith('.'):
-                full_path = os.path.join(root, file)
-                markdown_files.append(full_path)
+    # Parsing is CPU-bound regex work and independent per file, so fan it out
+    # across cores, streaming files into the pool as the walk finds them
+    with ProcessPoolExecutor() as executor:
+        results = list(tqdm(executor.map(process_wiki_file_logged, iter_markdown_files(wiki_path), chunksize=8),
+                            desc="📄 Parsing wiki", unit="file"))
     
-    print(f"📚 Found {len(markdown_files)} markdown files")
-    
-    for file_path in markdown_files:
-        try:
-            print(f"📄 Processing {os.path.basename(file_path)}...")
-            file_embeddings = process_wiki_file(file_path)
-            all_embeddings.extend(file_embeddings)
-            print(f"  ✓ Generated {len(file_embeddings)} embeddings")
-        except Exception as e:
-            print(f"  ❌ Error processing {file_path}: {e}")
+    print(f"📚 Processed {len(results)} markdown files")
+    all_embeddings = list(itertools.chain.from_iterable(results))
     
     print(f"📊 Generated {len(all_embeddings)} total wiki embeddings")
     return all_embeddings
 
-def generate_wiki_embeddings(wiki_embeddings: List[Dict]) -> List[Dict]:
-    """Generate embeddings for wiki content using the sentence transformer model"""
-    print("🧠 Generating embeddings for wiki content...")
-    
-    processed_embeddings = []
+def build_wiki_records(wiki_embeddings: List[Dict], now: int) -> List[Dict]:
+    """Build canister records (without vectors) for processed wiki content, created at `now`"""
+    records = []
     
-    for i, item in enumerate(wiki_embeddings, 1):
-        try:
-            # Generate embedding vector
-            embedding_vector = model.encode(item["text"]).tolist()
-            
-            # Create the structure expected by the canister
-            embedding_record = {
-                "text": item["text"],
-                "embedding": embedding_vector,
-                "channel_id": "#wiki",  # Special channel for wiki content
-                "category": item["category"],
-                "importance": item["importance"],
-                "created_at": int(time.time()),
-                "source_file": item.get("source_file", "unknown"),
-                "content_type": item.get("content_type", "general")
-            }
-            
-            processed_embeddings.append(embedding_record)
-            
-            if i % 10 == 0:
-                print(f"  📈 Processed {i}/{len(wiki_embeddings)} wiki embeddings...")
-                
-        except Exception as e:
-            print(f"  ❌ Error generating embedding for item {i}: {e}")
+    for item in wiki_embeddings:
+        # Create the structure expected by the canister
+        records.append({
+            "text": item["text"],
+            "channel_id": "#wiki",  # Special channel for wiki content
+            "category": item["category"],
+            "importance": item["importance"],
+            "created_at": now,
+            "source_file": item.get("source_file", "unknown"),
+            "content_type": item.get("content_type", "general")
+        })
     
-    return processed_embeddings
+    return records
 
-def generate_embeddings_for_channel(channel_id: str, personality_data: List[Dict]) -> List[Dict]:
-    """Generate embeddings for a specific channel's personality data"""
-    embeddings = []
+def build_personality_records(channel_id: str, personality_data: List[Dict], now: int) -> List[Dict]:
+    """Build canister records (without vectors) for a channel's personality data, created at `now`"""
+    records = []
     
     for item in personality_data:
-        # Generate embedding
-        embedding_vector = model.encode(item["text"]).tolist()
-        
         # Create the structure expected by the canister
-        embedding_record = {
+        records.append({
             "text": item["text"],
-            "embedding": embedding_vector,
             "channel_id": channel_id,
             "category": item["category"],
             "importance": item["importance"],
-            "created_at": int(time.time())
-        }
-        
-        embeddings.append(embedding_record)
-        print(f"Generated embedding for: {item['text'][:60]}...")
+            "created_at": now
+        })
     
-    return embeddings
+    return records
 
-def format_for_dfx(embeddings: List[Dict]) -> str:
-    """Format embeddings for dfx canister call"""
-    formatted_records = []
-    
-    for emb in embeddings:
-        # Format the embedding vector for Candid with explicit float32 type
-        embedding_values = [f"{f}:float32" for f in emb["embedding"]]
-        embedding_str = "; ".join(embedding_values)
-        
-        # Escape quotes in text
-        escaped_text = emb["text"].replace('"', '\\"')
-        
-        record = f'''record {{
-            text = "{escaped_text}";
-            embedding = vec {{ {embedding_str} }};
-            channel_id = "{emb["channel_id"]}";
-            category = "{emb["category"]}";
-            importance = {emb["importance"]}:float32;
-            created_at = {emb["created_at"]}:nat64;
-        }}'''
-        
-        formatted_records.append(record)
+def embed_records(records: List[Dict]) -> List[Dict]:
+    """Attach embedding vectors to records using one model.encode() call"""
+    texts = [record["text"] for record in records]
+    vectors = encode_texts(texts)
     
-    return f"(vec {{ {'; '.join(formatted_records)} }})"
+    # Rows stay float32 ndarrays; they are only converted when saved or Candid-encoded
+    return [{**record, "embedding": vector} for record, vector in zip(records, vectors)]
 
-def upload_to_canister_batch(embeddings: List[Dict], batch_size: int = 3, canister_name: str = "ai_api_backend"):
-    """Upload embeddings to the IC canister in smaller batches"""
-    print(f"Uploading {len(embeddings)} embeddings in batches of {batch_size}...")
+def reuse_saved_timestamps(records: List[Dict], path: str = EMBEDDINGS_FILE):
+    """Give records already in the backup (same channel, category and text) their saved
+    created_at, so a rerun over unchanged content reproduces the backup exactly"""
+    if not os.path.exists(path):
+        return
+    
+    with np.load(path) as saved:
+        saved_records = json.loads(str(saved['meta']))
+    
+    created_at = {(rec["channel_id"], rec["category"], rec["text"]): rec["created_at"] for rec in saved_records}
+    for record in records:
+        key = (record["channel_id"], record["category"], record["text"])
+        record["created_at"] = created_at.get(key, record["created_at"])
+
+def save_embeddings(embeddings: List[Dict], path: str = EMBEDDINGS_FILE) -> bool:
+    """Save vectors and the remaining fields to one compressed .npz.
     
-    total_batches = (len(embeddings) + batch_size - 1) // batch_size
-    successful_uploads = 0
+    Returns False without writing when the file already holds the same content.
+    """
+    vecs = np.stack([emb['embedding'] for emb in embeddings]).astype(np.float32, copy=False)
+    meta = json.dumps([{key: value for key, value in emb.items() if key != 'embedding'} for emb in embeddings])
     
-    for i in range(0, len(embeddings), batch_size):
-        batch = embeddings[i:i + batch_size]
-        batch_num = (i // batch_size) + 1
-        
-        print(f"📦 Uploading batch {batch_num}/{total_batches} ({len(batch)} embeddings)...")
-        
-        formatted_data = format_for_dfx(batch)
-        
-        # Create the dfx command with IC network
-        cmd = [
-            "dfx", "canister", "call", "--network", "ic", canister_name, 
-            "store_personality_batch", formatted_data
-        ]
-        
-        try:
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            print(f"✅ Batch {batch_num} success: {result.stdout.strip()}")
-            successful_uploads += len(batch)
-        except subprocess.CalledProcessError as e:
-            print(f"❌ Batch {batch_num} failed: {e.stderr}")
-            return False
-        except OSError as e:
-            if e.errno == 7:  # Argument list too long
-                print(f"⚠️  Batch {batch_num} too large, trying individual uploads...")
-                # Fall back to individual uploads for this batch
-                for single_embedding in batch:
-                    if upload_single_embedding(single_embedding, canister_name):
-                        successful_uploads += 1
-                    else:
-                        return False
-            else:
-                print(f"❌ System error in batch {batch_num}: {e}")
+    if os.path.exists(path):
+        with np.load(path) as saved:
+            if str(saved['meta']) == meta and np.array_equal(saved['vecs'], vecs):
                 return False
     
-    print(f"🎉 Successfully uploaded {successful_uploads}/{len(embeddings)} embeddings!")
-    return successful_uploads == len(embeddings)
-
-def upload_single_embedding(embedding: Dict, canister_name: str = "ai_api_backend"):
-    """Upload a single embedding to the canister"""
-    formatted_data = format_for_dfx([embedding])
-    
-    # Use the single embedding endpoint with IC network
-    cmd = [
-        "dfx", "canister", "call", "--network", "ic", canister_name, 
-        "store_personality", formatted_data.replace("(vec { ", "(").replace(" })", ")")
-    ]
-    
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-        print(f"  ✓ Uploaded: {embedding['text'][:40]}...")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"  ✗ Failed: {embedding['text'][:40]}... - {e.stderr}")
-        return False
+    np.savez_compressed(path, meta=meta, vecs=vecs)
+    return True
 
 def main():
     print("🧠 Generating Lain's personality and memex-wiki embeddings...")
     
-    all_embeddings = []
+    records = []
+    now = int(time.time())  # One timestamp for the whole run
     
-    # Generate personality embeddings for each channel
+    # Collect personality records for each channel
     print("\n📡 Processing personality data...")
     for channel_id, personality_data in LAIN_PERSONALITY.items():
-        print(f"  Processing {channel_id}...")
-        channel_embeddings = generate_embeddings_for_channel(channel_id, personality_data)
-        all_embeddings.extend(channel_embeddings)
+        records.extend(build_personality_records(channel_id, personality_data, now))
     
-    print(f"✓ Generated {len(all_embeddings)} personality embeddings")
+    personality_count = len(records)
+    print(f"✓ Collected {personality_count} personality records")
     
     # Process memex-wiki content
     print("\n📚 Processing memex-wiki content...")
     wiki_content = process_memex_wiki()
     if wiki_content:
-        wiki_embeddings = generate_wiki_embeddings(wiki_content)
-        all_embeddings.extend(wiki_embeddings)
-        print(f"✓ Generated {len(wiki_embeddings)} wiki embeddings")
+        records.extend(build_wiki_records(wiki_content, now))
+        print(f"✓ Collected {len(records) - personality_count} wiki records")
     else:
         print("⚠️  No wiki content processed")
     
+    # Only new or changed texts get this run's timestamp
+    reuse_saved_timestamps(records)
+    
+    # Encode personality + wiki texts together so batching amortizes across the whole corpus
+    print(f"\n🧠 Encoding {len(records)} texts in one batch...")
+    all_embeddings = embed_records(records)
+    
     print(f"\n📊 Total embeddings generated: {len(all_embeddings)}")
     
     # Categorize embeddings for summary
@@ -577,31 +540,27 @@ def main():
         print(f"  {category}: {count}")
     
     # Option to save to file first (for backup/inspection)
-    output_file = "lain_personality_embeddings.json"
-    with open(output_file, "w") as f:
-        json.dump(all_embeddings, f, indent=2)
-    print(f"\n💾 Saved embeddings to {output_file}")
+    if save_embeddings(all_embeddings):
+        print(f"\n💾 Saved embeddings to {EMBEDDINGS_FILE}")
+    else:
+        print(f"\n💾 {EMBEDDINGS_FILE} is already up to date")
     
     # Upload to canister
     upload_choice = input("\n🚀 Upload to IC canister? (y/n): ").lower().strip()
     if upload_choice in ['y', 'yes']:
-        print("\n🚀 Uploading to IC canister individually...")
-        successful_uploads = 0
+        # As few update calls as the ingress size limit allows, sent concurrently
+        batches = split_batches(all_embeddings)
+        print(f"\n🚀 Uploading to IC canister in {len(batches)} batch call(s)...")
+        client = CanisterClient()
+        results = client.store_batches_concurrently(batches)
         
-        for i, embedding in enumerate(all_embeddings, 1):
-            source_info = ""
-            if 'source_file' in embedding:
-                source_info = f" [{embedding['source_file']}]"
-            
-            print(f"📤 Uploading {i}/{len(all_embeddings)}: {embedding['text'][:50]}...{source_info}")
-            
-            if upload_single_embedding(embedding):
-                successful_uploads += 1
+        successful_uploads = 0
+        for batch_num, (batch, result) in enumerate(zip(batches, results), 1):
+            if isinstance(result, Exception):
+                print(f"❌ Batch {batch_num} ({len(batch)} embeddings) failed: {result}")
             else:
-                print(f"❌ Failed to upload embedding {i}")
-                retry = input("Continue with remaining uploads? (y/n): ").lower().strip()
-                if retry not in ['y', 'yes']:
-                    break
+                print(f"✅ Batch {batch_num} success: {result}")
+                successful_uploads += len(batch)
         
         if successful_uploads == len(all_embeddings):
             print(f"🎉 Successfully uploaded all {successful_uploads} embeddings!")
@@ -8,9 +8,9 @@ import subprocess
 import sys
 
 def run_dfx_command(command):
-    """Run a dfx command and return the output."""
+    """Run a dfx command (an argument list, executed without a shell) and return the output."""
     try:
-        result = subprocess.run(command, shell=True, capture_output=True, text=True)
+        result = subprocess.run(command, capture_output=True, text=True)
         if result.returncode == 0:
             return result.stdout.strip()
         else:
@@ -21,14 +21,14 @@ def run_dfx_command(command):
 def test_knowledge_stats():
     """Test getting knowledge statistics."""
     print("🔍 Testing knowledge statistics...")
-    command = "dfx canister call ai_api_backend get_knowledge_stats --network ic"
+    command = ["dfx", "canister", "call", "ai_api_backend", "get_knowledge_stats", "--network", "ic"]
     result = run_dfx_command(command)
     print(f"Result: {result}\n")
 
 def test_knowledge_categories():
     """Test getting knowledge categories."""
     print("📚 Testing knowledge categories...")
-    command = "dfx canister call ai_api_backend get_knowledge_categories --network ic"
+    command = ["dfx", "canister", "call", "ai_api_backend", "get_knowledge_categories", "--network", "ic"]
     result = run_dfx_command(command)
     print(f"Result: {result}\n")
 
@@ -36,7 +36,8 @@ def test_search_by_text():
     """Test searching by text without vector embeddings."""
     print("🔎 Testing text-based search...")
     # Simple text search for "blockchain"
-    command = 'dfx canister call ai_api_backend search_unified_knowledge \'(vec {0.1:float32; 0.2:float32}, 5:nat64, opt "personality")\' --network ic'
+    command = ["dfx", "canister", "call", "ai_api_backend", "search_unified_knowledge",
+               '(vec {0.1:float32; 0.2:float32}, 5:nat64, opt "personality")', "--network", "ic"]
     result = run_dfx_command(command)
     print(f"Result: {result}\n")
 
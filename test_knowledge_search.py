@@ -4,117 +4,161 @@ Test script for the unified knowledge search functionality
 """
 
 import json
-import subprocess
-from sentence_transformers import SentenceTransformer
 
-# Load the same model used by the canister
-model = SentenceTransformer('all-MiniLM-L6-v2')
+import numpy as np
+
+# Use the same model that generated the stored embeddings
+from encoder import encode_texts, l2_normalize
+from canister_client import CanisterClient
+
+EMBEDDINGS_FILE = "lain_personality_embeddings.npz"
 
 def generate_query_embedding(query_text):
     """Generate embedding for a query"""
-    return model.encode(query_text).tolist()
+    return generate_query_embeddings([query_text])[0]
+
+def generate_query_embeddings(query_texts):
+    """Generate embeddings for several queries in one batched call"""
+    return encode_texts(query_texts)
 
-def test_unified_search(query_text, categories=None, limit=5):
+def print_results(results):
+    """Print search results, best match first"""
+    print(f"📊 Results:")
+    for result in results:
+        print(f"  [{result['similarity']:.3f}] {result['category']} ({result['content_type']}): "
+              f"{result['text'][:100]}")
+
+def test_unified_search(query_text, categories=None, limit=5, query_embedding=None, client=None):
     """Test the unified knowledge search"""
     print(f"🔍 Searching for: '{query_text}'")
     
-    # Generate query embedding
-    query_embedding = generate_query_embedding(query_text)
-    
-    # Format embedding for dfx call
-    embedding_str = "; ".join([f"{f}:float32" for f in query_embedding])
+    # Generate query embedding unless the caller already batch-encoded it
+    if query_embedding is None:
+        query_embedding = generate_query_embedding(query_text)
     
-    # Prepare dfx command
-    if categories:
-        categories_str = "; ".join([f'"{cat}"' for cat in categories])
-        cmd = [
-            "dfx", "canister", "call", "--network", "ic", "ai_api_backend",
-            "search_unified_knowledge",
-            f"(vec {{{embedding_str}}}; opt vec {{{categories_str}}}; opt {limit}:nat32)"
-        ]
-    else:
-        cmd = [
-            "dfx", "canister", "call", "--network", "ic", "ai_api_backend",
-            "search_unified_knowledge", 
-            f"(vec {{{embedding_str}}}; null; opt {limit}:nat32)"
-        ]
+    # The agent sends the vector as packed float32, no text Candid to format or parse
+    client = client or CanisterClient()
     
     print(f"💫 Running search...")
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        results = client.search_unified_knowledge(query_embedding, categories, limit)
         print(f"✅ Search successful!")
-        print(f"📊 Results:")
-        print(result.stdout)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Search failed: {e.stderr}")
+        print_results(results)
+        return results
+    except Exception as e:
+        print(f"❌ Search failed: {e}")
         return None
 
-def test_wiki_search(query_text, content_type=None, limit=3):
+def test_wiki_search(query_text, content_type=None, limit=3, query_embedding=None, client=None):
     """Test the wiki-specific search"""
     print(f"📚 Wiki search for: '{query_text}'")
     
-    # Generate query embedding
-    query_embedding = generate_query_embedding(query_text)
-    
-    # Format embedding for dfx call
-    embedding_str = "; ".join([f"{f}:float32" for f in query_embedding])
+    # Generate query embedding unless the caller already batch-encoded it
+    if query_embedding is None:
+        query_embedding = generate_query_embedding(query_text)
     
-    # Prepare dfx command
-    if content_type:
-        cmd = [
-            "dfx", "canister", "call", "--network", "ic", "ai_api_backend",
-            "search_wiki_content",
-            f"(vec {{{embedding_str}}}; opt \"{content_type}\"; opt {limit}:nat32)"
-        ]
-    else:
-        cmd = [
-            "dfx", "canister", "call", "--network", "ic", "ai_api_backend",
-            "search_wiki_content", 
-            f"(vec {{{embedding_str}}}; null; opt {limit}:nat32)"
-        ]
+    # The agent sends the vector as packed float32, no text Candid to format or parse
+    client = client or CanisterClient()
     
     print(f"📖 Running wiki search...")
     
     try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        results = client.search_wiki_content(query_embedding, content_type, limit)
         print(f"✅ Wiki search successful!")
-        print(f"📊 Results:")
-        print(result.stdout)
-        return result.stdout
-    except subprocess.CalledProcessError as e:
-        print(f"❌ Wiki search failed: {e.stderr}")
+        print_results(results)
+        return results
+    except Exception as e:
+        print(f"❌ Wiki search failed: {e}")
         return None
 
+def load_local_index(path=EMBEDDINGS_FILE):
+    """Load the local backup once as a contiguous float32 matrix of unit rows"""
+    with np.load(path) as data:
+        metadata = json.loads(str(data['meta']))
+        vectors = np.ascontiguousarray(l2_normalize(data['vecs'].astype(np.float32)))
+    
+    importances = np.array([record["importance"] for record in metadata], dtype=np.float32)
+    return metadata, vectors, importances
+
+def rerank(query_embedding, vectors, importances, limit):
+    """Top `limit` row indices by similarity × importance, best first (the canister's ranking), and all scores"""
+    # Rows and query are unit length, so one matrix-vector product gives every cosine similarity
+    scores = (vectors @ l2_normalize(query_embedding[np.newaxis])[0]) * importances
+    if limit < len(scores):
+        top = np.argpartition(-scores, limit - 1)[:limit]
+    else:
+        top = np.arange(len(scores))
+    return top[np.argsort(-scores[top], kind='stable')], scores
+
+def test_local_search(query_text, local_index, limit=5, query_embedding=None):
+    """Rank the local backup the way search_unified_knowledge does, to cross-check the canister"""
+    print(f"💾 Local search for: '{query_text}'")
+    
+    # Generate query embedding unless the caller already batch-encoded it
+    if query_embedding is None:
+        query_embedding = generate_query_embedding(query_text)
+    
+    metadata, vectors, importances = local_index
+    top, scores = rerank(np.asarray(query_embedding, dtype=np.float32), vectors, importances, limit)
+    
+    print(f"📊 Results:")
+    for i in top:
+        print(f"  [{scores[i]:.3f}] {metadata[i]['category']}: {metadata[i]['text'][:100]}")
+    return [metadata[i] for i in top]
+
 def main():
     print("🚀 Testing Unified Knowledge Search System")
     print("=" * 50)
     
+    # Encode every test query up front in one batch
+    queries = [
+        "blockchain technology and decentralized systems",
+        "programming languages and technical preferences",
+        "autonomous AI governance and decision making",
+        "Internet Computer development setup and deployment",
+    ]
+    query_embeddings = generate_query_embeddings(queries)
+    
+    # One agent (and connection pool) for every search
+    client = CanisterClient()
+    
     # Test 1: General knowledge search
     print("\\n🧪 Test 1: General search about 'blockchain technology'")
-    test_unified_search("blockchain technology and decentralized systems")
+    test_unified_search(queries[0], query_embedding=query_embeddings[0], client=client)
     
     print("\\n" + "="*50)
     
     # Test 2: Personality-focused search  
     print("\\n🧪 Test 2: Personality search about 'programming preferences'")
-    test_unified_search("programming languages and technical preferences", 
-                       categories=["technical_preference", "programming_philosophy"])
+    test_unified_search(queries[1], 
+                       categories=["technical_preference", "programming_philosophy"],
+                       query_embedding=query_embeddings[1],
+                       client=client)
     
     print("\\n" + "="*50)
     
     # Test 3: Wiki-specific search
     print("\\n🧪 Test 3: Wiki search about 'lain.ai project'")
-    test_wiki_search("autonomous AI governance and decision making", 
-                    content_type="project-docs")
+    test_wiki_search(queries[2], 
+                    content_type="project-docs",
+                    query_embedding=query_embeddings[2],
+                    client=client)
     
     print("\\n" + "="*50)
     
     # Test 4: Technical documentation search
     print("\\n🧪 Test 4: Technical guide search about 'ICP development'")
-    test_wiki_search("Internet Computer development setup and deployment", 
-                    content_type="tech-guides")
+    test_wiki_search(queries[3], 
+                    content_type="tech-guides",
+                    query_embedding=query_embeddings[3],
+                    client=client)
+    
+    print("\\n" + "="*50)
+    
+    # Test 5: Same query as Test 1, ranked locally against the backup
+    print("\\n🧪 Test 5: Local search over the embeddings backup")
+    test_local_search(queries[0], load_local_index(), query_embedding=query_embeddings[0])
     
     print("\\n🎉 All tests completed!")
     print("\\n📝 Summary:")